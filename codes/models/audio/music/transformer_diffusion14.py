@@ -1,17 +1,264 @@
+import functools
 import itertools
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import maybe_bnb as mbnb
 
 from models.arch_util import TimestepEmbedSequential
 from models.audio.music.encoders import ResEncoder16x
-from models.audio.music.transformer_diffusion13 import ConcatAttentionBlock
 from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
+from models.diffusion.unet_diffusion import TimestepBlock
+from models.lucidrains.x_transformers import RMSNorm
 from trainer.networks import register_model
 from utils.util import checkpoint, print_network
 
 
+# All blocks in this module operate on [B, N, C] tensors. Parameters keep the names and (squeezed) shapes of the
+# channel-first modules they replace, see TransformerDiffusion._upgrade_legacy_state_dict.
+
+
+@functools.lru_cache(maxsize=8)
+def _nearest_indices(src_len, dst_len, device):
+    return torch.arange(dst_len, device=device) * src_len // dst_len
+
+
+def nearest_upsample(x, size):
+    """
+    Nearest-neighbor resampling of a [B, N, C] tensor to `size` elements along N. Equivalent to
+    F.interpolate(mode='nearest'), but lowers to a single repeat or gather.
+    """
+    n = x.shape[1]
+    if size % n == 0:
+        return x.repeat_interleave(size // n, dim=1)
+    return x.index_select(1, _nearest_indices(n, size, x.device))
+
+
+class GroupNormNLC(nn.GroupNorm):
+    """
+    GroupNorm over the channels of a [B, N, C] input, computed in fp32. Shares nn.GroupNorm's parameters.
+    """
+    def forward(self, x):
+        # A single copy both casts to fp32 and lays the input out channel-first for the native group_norm kernel.
+        h = x.transpose(1, 2).to(torch.float, memory_format=torch.contiguous_format)
+        h = F.group_norm(h, self.num_groups, self.weight, self.bias, self.eps)
+        return h.transpose(1, 2).type(x.dtype)
+
+
+def trunk_norm(channels, groups, use_rmsnorm):
+    return RMSNorm(channels) if use_rmsnorm else GroupNormNLC(groups, channels)
+
+
+class ConvNLC(nn.Conv1d):
+    """
+    Conv1d applied along the sequence dimension of a [B, N, C] input.
+    """
+    def forward(self, x):
+        return super().forward(x.permute(0, 2, 1)).permute(0, 2, 1)
+
+
+def gelu_gate(x):
+    x, gate = x.chunk(2, dim=-1)
+    return x * F.gelu(gate)
+
+
+@functools.lru_cache(maxsize=1)
+def compiled_gelu_gate():
+    """
+    gelu_gate compiled once and shared by every GLU. It only takes a tensor, so its guards do not depend on which module
+    calls it and the compiled graph is reused across all of them.
+    """
+    return torch.compile(gelu_gate)
+
+
+class GLU(nn.Module):
+    """
+    Gated GELU for channel-last architectures. With compile_gate, the chunk, GELU and product are fused into one kernel.
+    """
+    def __init__(self, dim_in, dim_out=None, compile_gate=False):
+        super().__init__()
+        dim_out = dim_in if dim_out is None else dim_out
+        self.proj = mbnb.nn.Linear(dim_in, dim_out * 2)
+        self.gate = compiled_gelu_gate() if compile_gate else gelu_gate
+
+    def forward(self, x):
+        return self.gate(self.proj(x))
+
+
+@functools.lru_cache(maxsize=8)
+def _local_window_layout(n, l, device):
+    """
+    Returns the emb indices ([l, 3l]) and validity mask ([N/l, l, 3l]) used by LocalQKBias. These only depend on the
+    sequence length, so they are built once and shared by every SubBlock.
+    """
+    num_blocks = (n + l - 1) // l
+    q = torch.arange(l, device=device)
+    k = torch.arange(3*l, device=device)
+    # Block i of queries is paired with blocks i-1, i and i+1 of keys.
+    dist = (k.unsqueeze(0) - l - q.unsqueeze(1)).abs()
+    k_pos = torch.arange(num_blocks, device=device).unsqueeze(1) * l + k - l
+    valid = (dist < l).unsqueeze(0) & ((k_pos >= 0) & (k_pos < n)).unsqueeze(1)
+    return (l - dist).clamp(min=0), valid
+
+
+class LocalQKBias(nn.Module):
+    """
+    Relative position bias for local attention, where each element attends to the elements fewer than l positions away.
+    Rather than an [N, N] matrix, produces the [N/l, l, 3l] additive bias consumed by local_attention(), with -inf
+    outside of the local window and past the ends of the sequence. Parameters match RelativeQKBias(l, symmetric=True).
+    """
+    def __init__(self, l):
+        super().__init__()
+        self.l = l
+        self.emb = nn.Parameter(torch.randn(l+1) * .01)
+
+    def forward(self, n):
+        index, valid = _local_window_layout(n, self.l, self.emb.device)
+        return torch.where(valid, self.emb[index], -torch.inf)
+
+
+def _neighbor_blocks(t, l, num_blocks, pad):
+    b, h, n, d = t.shape
+    t = F.pad(t, (0, 0, l, pad + l)).view(b * h, num_blocks + 2, l, d)
+    return torch.cat([t[:, :-2], t[:, 1:-1], t[:, 2:]], dim=2)
+
+
+def local_attention(q, k, v, bias):
+    """
+    Attention in which queries are grouped into blocks of l elements that only attend to their own and the two
+    neighboring blocks of keys. Combined with a LocalQKBias, this gives the same result as dense attention under
+    build_local_attention_mask(n, l) at O(N*l) rather than O(N^2) cost.
+
+    :param q, k, v: [B, H, N, D] tensors.
+    :param bias: [N/l, l, 3l] bias produced by LocalQKBias.
+    :return: a [B, H, N, D] tensor.
+    """
+    b, h, n, d = q.shape
+    num_blocks, l = bias.shape[0], bias.shape[1]
+    pad = num_blocks * l - n
+    # Heads are folded into the batch so that the blocks line up with the leading dimension of the bias, which then
+    # broadcasts over every batch element and head.
+    q = F.pad(q, (0, 0, 0, pad)).reshape(b * h, num_blocks, l, d)
+    k = _neighbor_blocks(k, l, num_blocks, pad)
+    v = _neighbor_blocks(v, l, num_blocks, pad)
+    o = F.scaled_dot_product_attention(q, k, v, attn_mask=bias.to(q.dtype))
+    return o.reshape(b, h, num_blocks * l, d)[:, :, :n]
+
+
+class SDPAttentionBlock(nn.Module):
+    """
+    Local self attention block which computes attention with F.scaled_dot_product_attention over blocks of the input
+    (see local_attention()), which lets PyTorch dispatch to a fused kernel and never materializes an [N, N] matrix.
+    Parameter names and head layout match AttentionBlock so its checkpoints load unchanged.
+    """
+    def __init__(self, channels, out_channels, num_heads, do_checkpoint=True, use_rmsnorm=False):
+        super().__init__()
+        assert (
+            out_channels % num_heads == 0
+        ), f"q,k,v channels {out_channels} is not divisible by num_heads {num_heads}"
+        self.num_heads = num_heads
+        self.do_checkpoint = do_checkpoint
+        self.norm = trunk_norm(channels, normalization(channels).num_groups, use_rmsnorm)
+        self.qkv = mbnb.nn.Linear(channels, out_channels * 3)
+        self.x_proj = nn.Identity() if out_channels == channels else mbnb.nn.Linear(channels, out_channels)
+        self.proj_out = zero_module(mbnb.nn.Linear(out_channels, out_channels))
+
+    def forward(self, x, local_bias):
+        if self.do_checkpoint:
+            return checkpoint(self._forward, x, local_bias)
+        return self._forward(x, local_bias)
+
+    def _forward(self, x, local_bias):
+        b, n, c = x.shape
+        x = self.norm(x)
+        # Heads are split out before q, k and v, matching QKVAttentionLegacy.
+        qkv = self.qkv(x).view(b, n, self.num_heads, -1).transpose(1, 2)
+        h = local_attention(*qkv.chunk(3, dim=-1), local_bias)
+        h = self.proj_out(h.transpose(1, 2).reshape(b, n, -1))
+        return self.x_proj(x) + h
+
+
+class SubBlock(nn.Module):
+    def __init__(self, inp_dim, contraction_dim, heads, dropout, use_rmsnorm=False, compile_ff=False):
+        super().__init__()
+        self.dropout = nn.Dropout(p=dropout)
+        self.attn = SDPAttentionBlock(inp_dim, out_channels=contraction_dim, num_heads=heads, use_rmsnorm=use_rmsnorm)
+        self.pos_bias = LocalQKBias(l=64)
+        ff_contract = contraction_dim//2
+        self.ff_contract = ff_contract
+        self.ff1 = nn.Sequential(mbnb.nn.Linear(inp_dim+contraction_dim, ff_contract),
+                                 trunk_norm(ff_contract, 8, use_rmsnorm),
+                                 GLU(ff_contract, compile_gate=compile_ff))
+        self.ff2 = nn.Sequential(ConvNLC(inp_dim+contraction_dim*3//2, ff_contract, kernel_size=3, padding=1),
+                                 trunk_norm(ff_contract, 8, use_rmsnorm),
+                                 GLU(ff_contract, compile_gate=compile_ff))
+
+    def drop(self, x, drop_mask):
+        return self.dropout(x) if drop_mask is None else x * drop_mask
+
+    def forward(self, x, drop_mask=None):
+        ah = self.drop(self.attn(x, self.pos_bias(x.shape[1])), drop_mask)
+        if not torch.is_grad_enabled():
+            # Without autograd, the output can be assembled in a single preallocated buffer instead of growing it with a
+            # cat per branch. With autograd, writing into the buffer would invalidate the slices saved for backward.
+            a, c, f = ah.shape[-1], x.shape[-1], self.ff_contract
+            h = x.new_empty((x.shape[0], x.shape[1], a + c + f*2), dtype=torch.promote_types(ah.dtype, x.dtype))
+            h[:, :, :a] = ah
+            h[:, :, a:a+c] = x
+            h[:, :, a+c:a+c+f] = self.drop(self.ff1(h[:, :, :a+c]), drop_mask)
+            h[:, :, a+c+f:] = self.drop(self.ff2(h[:, :, :a+c+f]), drop_mask)
+            return h
+
+        h = torch.cat([ah, x], dim=-1)
+        hf = self.drop(self.ff1(h), drop_mask)
+        h = torch.cat([h, hf], dim=-1)
+        hf = self.drop(self.ff2(h), drop_mask)
+        return torch.cat([h, hf], dim=-1)
+
+
+class ConcatAttentionBlock(TimestepBlock):
+    def __init__(self, trunk_dim, contraction_dim, blk_dim, heads, dropout, use_rmsnorm=False, adaln_blk_emb=False,
+                 compile_ff=False, token_dropout=False):
+        super().__init__()
+        self.contraction_dim = contraction_dim
+        self.dropout = dropout
+        self.token_dropout = token_dropout
+        self.adaln_blk_emb = adaln_blk_emb
+        self.prenorm = trunk_norm(trunk_dim, 8, use_rmsnorm)
+        if adaln_blk_emb:
+            self.tdim = trunk_dim
+            self.blk_mlp = mbnb.nn.Linear(blk_dim, trunk_dim*2)
+            self.blk_mlp.weight.data.zero_()
+            self.blk_mlp.bias.data.zero_()
+        else:
+            self.tdim = trunk_dim+blk_dim
+        # With token_dropout, dropout is applied by the mask drawn in forward() instead of within each SubBlock.
+        sub_dropout = 0 if token_dropout else dropout
+        self.block1 = SubBlock(self.tdim, contraction_dim, heads, sub_dropout, use_rmsnorm, compile_ff)
+        self.block2 = SubBlock(self.tdim+contraction_dim*2, contraction_dim, heads, sub_dropout, use_rmsnorm, compile_ff)
+        self.out = mbnb.nn.Linear(contraction_dim*4, trunk_dim, bias=False)
+        self.out.weight.data.zero_()
+
+    def forward(self, x, blk_emb):
+        h = self.prenorm(x)
+        if self.adaln_blk_emb:
+            scale, shift = self.blk_mlp(blk_emb).unsqueeze(1).chunk(2, dim=-1)
+            h = h * (1 + scale) + shift
+        else:
+            # expand() broadcasts blk_emb along the sequence without materializing a repeated copy ahead of the cat.
+            h = torch.cat([h, blk_emb.unsqueeze(1).expand(-1, x.shape[1], -1)], dim=-1)
+        # With token_dropout, one dropout mask over whole tokens ([B, N, 1]) is drawn per block and shared by every branch
+        # of both SubBlocks, rather than drawing a full-size mask for each branch.
+        drop_mask = None
+        if self.token_dropout and self.training and self.dropout > 0:
+            drop_mask = x.new_empty((x.shape[0], x.shape[1], 1)).bernoulli_(1 - self.dropout) / (1 - self.dropout)
+        h = self.block1(h, drop_mask)
+        h = self.block2(h, drop_mask)
+        h = self.out(h[:, :, -self.contraction_dim*4:])
+        return h + x
+
+
 class TransformerDiffusion(nn.Module):
     """
     A diffusion model composed entirely of stacks of transformer layers. Why would you do it any other way?
@@ -30,7 +277,13 @@ class TransformerDiffusion(nn.Module):
             use_corner_alignment=False,  # This is an interpolation parameter only provided for backwards compatibility. ALL NEW TRAINS SHOULD SET THIS TO TRUE.
             use_fp16=False,
             new_code_expansion=False,
+            compile_layers=False,  # Compiles each ConcatAttentionBlock with torch.compile. Works best with fixed training sequence lengths.
+            compile_ff=False,  # Compiles the GELU gate of each SubBlock feed-forward with torch.compile, as one graph shared by all of them. Redundant with compile_layers.
+            checkpoint_layer_interval=1,  # With checkpointing enabled, every n-th ConcatAttentionBlock is checkpointed whole and only the attention of the rest is. 0 checkpoints only the attention.
+            use_rmsnorm=False,  # Uses RMSNorm instead of GroupNorm throughout the trunk. Not compatible with checkpoints trained without it.
+            adaln_blk_emb=False,  # Applies the timestep embedding as a scale/shift on each block's prenorm instead of concatenating it to the block input. Not compatible with checkpoints trained without it.
             # Parameters for regularization.
+            token_dropout=False,  # Drops whole tokens with a single mask shared by every branch of a layer, instead of dropping elements of each branch independently. Cheaper, but a stronger regularizer.
             unconditioned_percentage=.1,  # This implements a mechanism similar to what is used in classifier-free training.
             # Parameters for re-training head
             freeze_except_code_converters=False,
@@ -54,11 +307,27 @@ class TransformerDiffusion(nn.Module):
             linear(time_embed_dim, time_embed_dim//4),
         )
 
-        self.input_converter = nn.Conv1d(input_vec_dim, model_channels, 1)
+        self.input_converter = mbnb.nn.Linear(input_vec_dim, model_channels)
         self.unconditioned_embedding = nn.Parameter(torch.randn(1,model_channels,1))
-        self.intg = nn.Conv1d(model_channels*2, model_channels, 1)
+        # Integrates the code embedding into the trunk. Equivalent to a single projection of cat([x, code_emb]).
+        self.intg_x = mbnb.nn.Linear(model_channels, model_channels)
+        self.intg_c = mbnb.nn.Linear(model_channels, model_channels, bias=False)
         self.layers = TimestepEmbedSequential(*[ConcatAttentionBlock(model_channels, contraction_dim, time_embed_dim//4,
-                                                                     num_heads, dropout) for _ in range(num_layers)])
+                                                                     num_heads, dropout, use_rmsnorm, adaln_blk_emb,
+                                                                     compile_ff, token_dropout)
+                                               for _ in range(num_layers)])
+        for i, lyr in enumerate(self.layers):
+            lyr.do_checkpoint = checkpoint_layer_interval > 0 and i % checkpoint_layer_interval == 0
+            # The attention is recomputed along with the rest of a checkpointed layer; checkpointing it again would
+            # recompute it twice.
+            lyr.block1.attn.do_checkpoint = lyr.block2.attn.do_checkpoint = not lyr.do_checkpoint
+        self.compile_ff = compile_ff
+        # Blocks are compiled individually and kept in a plain list so the compiled wrappers are not registered as
+        # duplicate submodules.
+        self.compiled_layers = None
+        if compile_layers:
+            self.compiled_layers = [torch.compile(lyr, mode='reduce-overhead', fullgraph=False, dynamic=False)
+                                    for lyr in self.layers]
 
         self.out = nn.Sequential(
             normalization(model_channels),
@@ -75,16 +344,35 @@ class TransformerDiffusion(nn.Module):
                     del p.DO_NOT_TRAIN
                     p.requires_grad = True
 
+        self._register_load_state_dict_pre_hook(self._upgrade_legacy_state_dict)
+
+    def _upgrade_legacy_state_dict(self, state_dict, prefix, *args):
+        """
+        Converts weights saved by earlier revisions of this model so that their checkpoints still load. Those revisions
+        used Conv1d(kernel_size=1) where nn.Linear is now used; the weights only differ by a trailing unit dimension.
+        They also used a single intg projection over cat([x, code_emb]), which is split column-wise here.
+        """
+        if prefix + 'intg.weight' in state_dict:
+            w = state_dict.pop(prefix + 'intg.weight')
+            w = w.squeeze(-1) if w.dim() == 3 else w
+            state_dict[prefix + 'intg_x.weight'], state_dict[prefix + 'intg_c.weight'] = w.chunk(2, dim=1)
+            state_dict[prefix + 'intg_x.bias'] = state_dict.pop(prefix + 'intg.bias')
+        for k, p in self.named_parameters():
+            k = prefix + k
+            if k in state_dict and state_dict[k].dim() == p.dim() + 1 and state_dict[k].shape[-1] == 1:
+                state_dict[k] = state_dict[k].squeeze(-1)
+
     def get_grad_norm_parameter_groups(self):
-        attn1 = list(itertools.chain.from_iterable([lyr.block1.attn.parameters() for lyr in self.layers]))
-        attn2 = list(itertools.chain.from_iterable([lyr.block2.attn.parameters() for lyr in self.layers]))
-        ff1 = list(itertools.chain.from_iterable([lyr.block1.ff1.parameters() for lyr in self.layers] +
-                                                 [lyr.block1.ff2.parameters() for lyr in self.layers]))
-        ff2 = list(itertools.chain.from_iterable([lyr.block2.ff1.parameters() for lyr in self.layers] +
-                                                 [lyr.block2.ff2.parameters() for lyr in self.layers]))
-        blkout_layers = list(itertools.chain.from_iterable([lyr.out.parameters() for lyr in self.layers]))
+        prenorms, attn1, attn2, ff1, ff2, blkout_layers = [], [], [], [], [], []
+        for lyr in self.layers:
+            prenorms.extend(lyr.prenorm.parameters())
+            attn1.extend(lyr.block1.attn.parameters())
+            attn2.extend(lyr.block2.attn.parameters())
+            ff1.extend(itertools.chain(lyr.block1.ff1.parameters(), lyr.block1.ff2.parameters()))
+            ff2.extend(itertools.chain(lyr.block2.ff1.parameters(), lyr.block2.ff2.parameters()))
+            blkout_layers.extend(lyr.out.parameters())
         groups = {
-            'prenorms': list(itertools.chain.from_iterable([lyr.prenorm.parameters() for lyr in self.layers])),
+            'prenorms': prenorms,
             'blk1_attention_layers': attn1,
             'blk2_attention_layers': attn2,
             'attention_layers': attn1 + attn2,
@@ -99,43 +387,68 @@ class TransformerDiffusion(nn.Module):
         }
         return groups
 
+    def export_for_inference(self, x, timesteps, prior, package_path):
+        """
+        Ahead-of-time compiles the conditioned forward pass with torch.export and AOTInductor, for sampling loops that
+        call the model many times with the same shapes. x, timesteps and prior are sample inputs (use a batch size > 1).
+        The batch dimension is exported as dynamic, as is the sequence length when x is an integer multiple of prior in
+        length. Returns the path of the package, which is loaded with torch._inductor.aoti_load_package() and called
+        like forward(x, timesteps, prior).
+        """
+        assert not self.training, 'Export the model in eval mode.'
+        assert self.compiled_layers is None, 'Export a model constructed without compile_layers.'
+        assert not self.compile_ff, 'Export a model constructed without compile_ff.'
+        batch = torch.export.Dim('batch')
+        x_dims, prior_dims = {0: batch}, {0: batch}
+        if x.shape[-1] % prior.shape[-1] == 0:
+            prior_seq = torch.export.Dim('prior_seq')
+            prior_dims[2] = prior_seq
+            x_dims[2] = prior_seq * (x.shape[-1] // prior.shape[-1])
+        program = torch.export.export(self, (x, timesteps, prior), strict=True,
+                                      dynamic_shapes={'x': x_dims, 'timesteps': {0: batch}, 'prior': prior_dims})
+        return torch._inductor.aoti_compile_and_package(program, package_path=package_path)
+
     def forward(self, x, timesteps, prior=None, conditioning_free=False):
+        unconditioned_embedding = self.unconditioned_embedding.permute(0,2,1)
         if conditioning_free:
-            code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
+            # Left as [1, 1, C]: intg_c projects it once and the result broadcasts over the batch and sequence.
+            code_emb = unconditioned_embedding
         else:
-            code_emb = self.input_converter(prior)
+            code_emb = self.input_converter(prior.permute(0,2,1))
 
             # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
             if self.training and self.unconditioned_percentage > 0:
-                unconditioned_batches = torch.rand((code_emb.shape[0], 1, 1),
-                                                   device=code_emb.device) < self.unconditioned_percentage
-                code_emb = torch.where(unconditioned_batches, self.unconditioned_embedding.repeat(x.shape[0], 1, 1),
-                                       code_emb)
+                unconditioned_batches = torch.rand(code_emb.shape[0], device=code_emb.device) < self.unconditioned_percentage
+                # The [1, 1, C] embedding broadcasts over the batch and sequence, so it is never repeated.
+                code_emb = torch.where(unconditioned_batches[:, None, None], unconditioned_embedding, code_emb)
+            elif self.training:
+                # Defensively involve the otherwise unused embedding in the loss so we don't get DDP errors.
+                code_emb = code_emb + unconditioned_embedding.mean() * 0
 
-            code_emb = F.interpolate(code_emb, size=x.shape[-1], mode='nearest')
+            code_emb = nearest_upsample(code_emb, x.shape[-1])
 
         with torch.autocast(x.device.type, enabled=self.enable_fp16):
             blk_emb = self.time_embed(timestep_embedding(timesteps, self.time_embed_dim))
-            x = self.inp_block(x)
-
-            x = self.intg(torch.cat([x, code_emb], dim=1))
-            for layer in self.layers:
-                x = checkpoint(layer, x, blk_emb)
+            # The trunk runs in [B, N, C]; this and the permute into self.out are the only layout changes.
+            x = self.inp_block(x).permute(0,2,1)
 
-        x = x.float()
-        out = self.out(x)
+            x = self.intg_x(x) + self.intg_c(code_emb)
+            layers = self.layers if self.compiled_layers is None else self.compiled_layers
+            for lyr, layer in zip(self.layers, layers):
+                x = checkpoint(layer, x, blk_emb) if lyr.do_checkpoint else layer(x, blk_emb)
 
-        # Defensively involve probabilistic or possibly unused parameters in loss so we don't get DDP errors.
-        unused_params = [self.unconditioned_embedding]
-        extraneous_addition = 0
-        for p in unused_params:
-            extraneous_addition = extraneous_addition + p.mean()
-        out = out + extraneous_addition * 0
+            # The output head runs in the autocast dtype too; only its (narrower) result is returned in fp32.
+            out = self.out(x.permute(0,2,1)).float()
 
         return out
 
 
 class TransformerDiffusionWithCheaterLatent(nn.Module):
+    """
+    While the encoder is frozen, its parameters are involved in the output through a zero-valued term so that DDP does
+    not fail on them going unused. Once freeze_encoder_until is crossed they receive real gradients and are synced as
+    usual.
+    """
     def __init__(self, freeze_encoder_until=None, checkpoint_encoder=True, **kwargs):
         super().__init__()
         self.internal_step = 0
@@ -144,19 +457,17 @@ class TransformerDiffusionWithCheaterLatent(nn.Module):
         self.encoder = ResEncoder16x(256, 1024, 256, checkpointing_enabled=checkpoint_encoder)
 
     def forward(self, x, timesteps, truth_mel, conditioning_free=False, cheater=None):
-        unused_parameters = []
         encoder_grad_enabled = self.freeze_encoder_until is not None and self.internal_step > self.freeze_encoder_until
-        if not encoder_grad_enabled:
-            unused_parameters.extend(list(self.encoder.parameters()))
-
         if cheater is None:
             with torch.set_grad_enabled(encoder_grad_enabled):
                 proj = self.encoder(truth_mel)
         else:
             proj = cheater
 
-        for p in unused_parameters:
-            proj = proj + p.mean() * 0
+        # Defensively involve the frozen encoder's parameters in the loss so we don't get DDP errors.
+        if self.training and not encoder_grad_enabled:
+            for p in self.encoder.parameters():
+                proj = proj + p.mean() * 0
 
         diff = self.diff(x, timesteps, prior=proj, conditioning_free=conditioning_free)
         return diff
@@ -196,14 +507,32 @@ def register_transformer_diffusion_14_with_cheater_latent(opt_net, opt):
 
 
 def test_tfd():
+    mbnb.populate(False, False, False, embedding=None)
     clip = torch.randn(2,256,400)
     ts = torch.LongTensor([600, 600])
     model = TransformerDiffusion(in_channels=256, model_channels=1024, contraction_dim=512,
-                                              num_heads=3, input_vec_dim=256, num_layers=12, dropout=.1)
+                                              num_heads=4, input_vec_dim=256, num_layers=12, dropout=.1)
     model(clip, ts, clip)
 
 
+def test_export():
+    mbnb.populate(False, False, False, embedding=None)
+    clip = torch.randn(2,256,400)
+    prior = torch.randn(2,256,25)
+    ts = torch.LongTensor([600, 600])
+    model = TransformerDiffusion(in_channels=256, model_channels=1024, contraction_dim=512,
+                                 num_heads=8, input_vec_dim=256, num_layers=16, dropout=.1).eval()
+    compiled = torch._inductor.aoti_load_package(model.export_for_inference(clip, ts, prior, 'tfd14.pt2'))
+    with torch.no_grad():
+        print((compiled(clip, ts, prior) - model(clip, ts, prior)).abs().max())
+        # Exercises the dynamic batch and sequence dimensions, including a length that is not a multiple of the local
+        # attention block size.
+        clip, prior, ts = torch.randn(3,256,480), torch.randn(3,256,30), torch.LongTensor([10, 300, 900])
+        print((compiled(clip, ts, prior) - model(clip, ts, prior)).abs().max())
+
+
 def test_cheater_model():
+    mbnb.populate(False, False, False, embedding=None)
     clip = torch.randn(2, 256, 400)
     ts = torch.LongTensor([600, 600])
 
@@ -224,6 +553,17 @@ def test_cheater_model():
     pg = model.get_grad_norm_parameter_groups()
 
 
+def test_local_attention():
+    from models.arch_util import build_local_attention_mask, RelativeQKBias
+    q, k, v = torch.randn(3, 2, 4, 300, 32).unbind(0)
+    bias = LocalQKBias(l=64)
+    dense_bias = RelativeQKBias(l=64, max_positions=300)
+    dense_bias.emb.data.copy_(bias.emb.data)
+    dense_mask = dense_bias(300).masked_fill(build_local_attention_mask(300, 64).logical_not(), -torch.inf)
+    dense = F.scaled_dot_product_attention(q, k, v, attn_mask=dense_mask)
+    assert torch.allclose(local_attention(q, k, v, bias(300)), dense, atol=1e-5)
+
+
 def extract_cheater_encoder(in_f, out_f):
     p = torch.load(in_f)
     out = {}